@@ -1,4 +1,5 @@
 import logging
+import re
 import torch
 import numpy as np
 import torch.nn as nn
@@ -20,10 +21,9 @@ class CrossContext(nn.Module):
         Cross context aggregation module
         apply VN-TRANSFORMER to the input features
     """
-    def __init__(self, feature_dim=32, atten_multi_head_c=16, k=16):
+    def __init__(self, feature_dim=32, k=16):
         super(CrossContext, self).__init__()
         self.k_nn = k
-        self.atten_multi_head_c = atten_multi_head_c
         self.vn_mlp_q = VNLinearLeakyReLU(feature_dim, feature_dim, dim=3)
         self.chnorm = self.channel_equi_vec_normalize
         self.vn_mlp_k = VNLinearLeakyReLU(2*feature_dim, feature_dim)
@@ -32,10 +32,13 @@ class CrossContext(nn.Module):
     def channel_equi_vec_normalize(self, x):
         # B,C,3,...
         assert x.ndim >= 3, "x shape [B,C,3,...]"
-        x_dir = F.normalize(x, dim=2)
+        # x_dir * x_normalized_norm folded into one per-vector factor, so the
+        # vector norm is computed once and x is only scaled once
+        eps = 1e-12  # F.normalize default
         x_norm = x.norm(dim=2, keepdim=True)
-        x_normalized_norm = F.normalize(x_norm, dim=1)  # normalize across C
-        y = x_dir * x_normalized_norm
+        x_norm_c = x_norm.norm(dim=1, keepdim=True)  # normalize across C
+        scale = x_norm / (x_norm.clamp_min(eps) * x_norm_c.clamp_min(eps))
+        y = x * scale
         return y
 
     def forward(self, x, y):
@@ -43,26 +46,20 @@ class CrossContext(nn.Module):
         x: point features of shape [B, N_feat, 3, N_samples]
         '''
         # get graph feature calc the difference between the point and its neighbors and concatenate them.
-        # x = get_graph_feature(x, k=self.k_nn)
         Qx = self.chnorm(self.vn_mlp_q(x))
-        logging.info(f"Qx {Qx.size()}")
         y = get_graph_feature(y, k=self.k_nn)
-        logging.info(f"y {y.size()}")
         Ky = self.chnorm(self.vn_mlp_k(y))
         Vy = self.vn_mlp_v(y)
-        logging.info(f"Ky {Ky.size()}")
-        logging.info(f"Vy {Vy.size()}")
-        qk = (Ky * Qx[..., None]).sum(2)
-        logging.info(f"qk {qk.size()}")
-        B, C, N, K = qk.size()
-        N_head = C // self.atten_multi_head_c
-        qk = qk.view(B, N_head, self.atten_multi_head_c, N, K)
-        atten = qk / torch.sqrt(torch.tensor(3 * C, dtype=torch.float32))
-        atten = torch.softmax(atten, dim=-1)
-        atten = atten.expand(-1, -1, self.atten_multi_head_c, -1, -1).contiguous()
-        atten = atten.view(B, C, N, K).unsqueeze(2)
-        logging.info(f"atten {atten.size()}")
-        return x + (atten * Vy).sum(-1)
+        B, C, _, N, K = Ky.size()
+        # every channel attends on its own over the K neighbours with its 3D vector as
+        # query/key/value, so fold (B, C) into the batch and N into the head dimension
+        q = Qx.permute(0, 1, 3, 2).reshape(B * C, N, 1, 3)
+        k = Ky.permute(0, 1, 3, 4, 2).reshape(B * C, N, K, 3)
+        v = Vy.permute(0, 1, 3, 4, 2).reshape(B * C, N, K, 3)
+        scale = (3.0 * C) ** -0.5
+        out = F.scaled_dot_product_attention(q, k, v, scale=scale)
+        out = out.view(B, C, N, 3).permute(0, 1, 3, 2)
+        return x + out
 
 
 class GlobalContext(nn.Module):
@@ -78,24 +75,29 @@ class GlobalContext(nn.Module):
 class InvariantMapping(nn.Module):
     def __init__(self, in_feat):
         super(InvariantMapping, self).__init__()
+
+    @staticmethod
+    def mean_direction(f):
+        '''
+        f: point features of shape [B, N_feat, 3, N_samples]
+        returns the unit direction of the channel mean, [B, 3, N_samples]
+        '''
+        return F.normalize(f.mean(dim=1), dim=1, eps=1e-6)
     
     def forward(self, fx, fy, topk):
-        fx_mean = torch.mean(fx, dim=1)
-        fy_mean = torch.mean(fy, dim=1)
-        fx_par = fx_mean / (torch.norm(fx_mean, dim=1).unsqueeze(1).repeat(1, fx_mean.size(1), 1) + 1e-6)
-        fy_par = fy_mean / (torch.norm(fy_mean, dim=1).unsqueeze(1).repeat(1, fy_mean.size(1), 1) + 1e-6)
-        phi_x = torch.einsum('bcdn,bdn->bnc', fx, fx_par)
-        phi_y = torch.einsum('bcdn,bdn->bnc', fy, fy_par)
-        Sc = F.softmax(torch.einsum('bnc,bnc->bn', phi_x, phi_y), dim=-1)
-        logging.info(f"Sc {Sc.size()}")
-        idx = torch.topk(Sc, Sc.shape[1]//topk, dim=-1)[1]
-        logging.info(f"idx {idx.size()}")
+        fx_par = self.mean_direction(fx)
+        fy_par = self.mean_direction(fy)
+        # project every vector feature on the mean direction: [B, C, N]
+        phi_x = (fx * fx_par.unsqueeze(1)).sum(2)
+        phi_y = (fy * fy_par.unsqueeze(1)).sum(2)
+        Sc = F.softmax((phi_x * phi_y).sum(1), dim=-1)
+        # the kept nodes do not need to be ordered by score
+        idx = torch.topk(Sc, Sc.shape[1]//topk, dim=-1, sorted=False).indices
         b, c, n, s = fx.size()
-        idx = idx.unsqueeze(1).unsqueeze(2).expand(-1, c, 3, -1)
-        logging.info(f"idx {idx.size()}")
+        # gather does not broadcast its index, expand only creates a view
+        idx = idx[:, None, None, :].expand(-1, c, 3, -1)
         fx = fx.gather(-1, idx)
         fy = fy.gather(-1, idx)
-        logging.info(f"fx {fx.size()}")
         return fx, fy
 
 class HierarchicalAggregation(nn.Module):
@@ -104,31 +106,44 @@ class HierarchicalAggregation(nn.Module):
         self.vn_mlp = VNLinearLeakyReLU(in_feat, out_feat, dim=3)
     
     def forward(self, fx):
+        # fx holds the mean pooled [B, C_i, 3] block features, the concat is small. Summing
+        # per-block VNLinearLeakyReLU outputs instead would not match: the nonlinearity acts on the sum
         return self.vn_mlp(torch.cat(fx, dim=1))
 
 class Alignment(nn.Module):
-    def __init__(self):
+    def __init__(self, svd_device=None):
         super(Alignment, self).__init__()
+        # device for the batched 3x3 SVD, e.g. 'cpu' where launching the GPU solver
+        # costs more than the round trip, None keeps it on the device of the features
+        self.svd_device = svd_device
     
     def forward(self, fx, fy):
-        H = torch.einsum('bcd,bce->bde', fx, fy)
-        u, s, v = torch.linalg.svd(H)
-        R = torch.matmul(u, v)
-        S = torch.norm(fy, dim=1)/torch.norm(fx, dim=1)
+        # SVD and the norm ratio are precision sensitive, keep them in float32 under autocast
+        with torch.autocast(device_type=fx.device.type, enabled=False):
+            fx, fy = fx.float(), fy.float()
+            H = torch.bmm(fx.transpose(1, 2), fy)
+            H_svd = H if self.svd_device is None else H.to(self.svd_device)
+            # batched Jacobi solver is much faster than the default cuSOLVER path for tiny matrices
+            driver = 'gesvdj' if H_svd.is_cuda else None
+            # torch.linalg.svd returns V^T (vh), not V
+            u, s, vh = torch.linalg.svd(H_svd, driver=driver)
+            R = (u @ vh).to(H.device)
+            S = torch.norm(fy, dim=1)/torch.norm(fx, dim=1)
         return R, S
 
 class EquivariantFeatureExtraction(nn.Module):
     def __init__(self, in_feat, out_feat, k):
         super(EquivariantFeatureExtraction, self).__init__()
         self.local_context_feat = VNDGCNN(in_feat, out_feat, k, pooling="mean")
-        self.cross_context = CrossContext(out_feat, 16, k)
+        self.cross_context = CrossContext(out_feat, k)
         self.global_context = GlobalContext(out_feat*2, out_feat)
         
     def forward(self, x, y):
         # 1. local context aggregation
         fx = self.local_context_feat(x)
         fy = self.local_context_feat(y)
-        # 2. cross context
+        # 2. cross context, fy attends to the already updated fx so the
+        # keys/values of the second call can not be built up front
         fx = self.cross_context(fx, fy)
         fy = self.cross_context(fy, fx)
         # 3. global context aggregation
@@ -144,80 +159,65 @@ class HEGN(nn.Module):
         self.num_blocks = args.num_blocks
         self.topk = args.topk
         self.cross_context_feat = args.vngcnn_out
-        self.feature_extraction1 = EquivariantFeatureExtraction(args.vngcnn_in[0], args.vngcnn_out[0], args.n_knn[0])
-        self.feature_extraction2 = EquivariantFeatureExtraction(args.vngcnn_in[1], args.vngcnn_out[1], args.n_knn[1])
-        self.feature_extraction3 = EquivariantFeatureExtraction(args.vngcnn_in[2], args.vngcnn_out[2], args.n_knn[2])
-        self.feature_extraction4 = EquivariantFeatureExtraction(args.vngcnn_in[3], args.vngcnn_out[3], args.n_knn[3])
-        self.invariant_mapping1 = InvariantMapping(args.vngcnn_out[0])
-        self.invariant_mapping2 = InvariantMapping(args.vngcnn_out[0])
-        self.invariant_mapping3 = InvariantMapping(args.vngcnn_out[0])
-        self.invariant_mapping4 = InvariantMapping(args.vngcnn_out[0])
+        self.feature_extraction = nn.ModuleList([
+            EquivariantFeatureExtraction(args.vngcnn_in[i], args.vngcnn_out[i], args.n_knn[i])
+            for i in range(self.num_blocks)])
+        self.invariant_mapping = nn.ModuleList([
+            InvariantMapping(args.vngcnn_out[i]) for i in range(self.num_blocks)])
         self.hierarchical_aggregation = HierarchicalAggregation(np.sum(args.vngcnn_out), args.vngcnn_out[-1])
-        self.alignment = Alignment()
+        self.alignment = Alignment(args.svd_device)
         self.pool = mean_pool
 
-    def forward(self, x, y):
-        logging.disable(logging.CRITICAL)
+    def features(self, x, y):
+        '''
+        equivariant features of x and y right before the alignment, both [B, C, 3]
+        '''
         fx_block = []
         fy_block = []
         # add feature dimension
         fx = x.unsqueeze(1)
         fy = y.unsqueeze(1)
-        logging.info(f"fx {fx.size()}")
-        logging.info(f"fy {fy.size()}")
-        # block 1
-        fx, fy = self.feature_extraction1(fx, fy)
-        fx, fy = self.invariant_mapping1(fx, fy, self.topk[0])
-        fx_block.append(fx)
-        fy_block.append(fy)
-        logging.info(f"fx {fx.size()}")
-        logging.info(f"fy {fy.size()}")
-        # block 2
-        fx, fy = self.feature_extraction2(fx, fy)
-        fx, fy = self.invariant_mapping2(fx, fy, self.topk[1])
-        fx_block.append(fx)
-        fy_block.append(fy)
-        logging.info(f"fx {fx.size()}")
-        logging.info(f"fy {fy.size()}")
-        # block 3
-        fx, fy = self.feature_extraction3(fx, fy)
-        fx, fy = self.invariant_mapping3(fx, fy, self.topk[2])
-        fx_block.append(fx)
-        fy_block.append(fy)
-        logging.info(f"fx {fx.size()}")
-        logging.info(f"fy {fy.size()}")
-        # block 4
-        fx, fy = self.feature_extraction4(fx, fy)
-        fx, fy = self.invariant_mapping4(fx, fy, self.topk[3])
-        fx_block.append(fx)
-        fy_block.append(fy)
-        logging.info(f"fx {fx.size()}")
-        logging.info(f"fy {fy.size()}")
+        # feature extraction + node pooling blocks
+        for i in range(self.num_blocks):
+            fx, fy = self.feature_extraction[i](fx, fy)
+            fx, fy = self.invariant_mapping[i](fx, fy, self.topk[i])
+            fx_block.append(fx)
+            fy_block.append(fy)
         # Hierarchical aggregation
         for i in range(self.num_blocks):
             fx_block[i] = self.pool(fx_block[i])
             fy_block[i] = self.pool(fy_block[i])
         fx = self.hierarchical_aggregation(fx_block)
         fy = self.hierarchical_aggregation(fy_block)
-        logging.info(f"fx {fx.size()}")
-        logging.info(f"fy {fy.size()}")
+        return fx, fy
+
+    def forward(self, x, y):
+        fx, fy = self.features(x, y)
         # 9Dof Alignment
         R, S = self.alignment(fx, fy)
-        logging.info(f"R {R.size()}")
-        logging.info(f"S {S.size()}")
         return R, S
 
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # checkpoints saved before the blocks were kept in a ModuleList
+        # name them feature_extraction1 ... feature_extraction4
+        for key in list(state_dict.keys()):
+            match = re.match(rf'{re.escape(prefix)}(feature_extraction|invariant_mapping)(\d+)\.(.*)', key)
+            if match:
+                name, block, rest = match.groups()
+                state_dict[f'{prefix}{name}.{int(block) - 1}.{rest}'] = state_dict.pop(key)
+        super(HEGN, self)._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
 class HEGN_Loss(nn.Module):
     def __init__(self):
         super(HEGN_Loss, self).__init__()
+        self.register_buffer('eye3', torch.eye(3), persistent=False)
     
     def forward(self, x_aligned, y, R, S, t, R_gt, S_gt, t_gt):
         t = t.squeeze()
         S = S.diagonal(dim1=-2, dim2=-1)
         S_gt = S_gt.diagonal(dim1=-2, dim2=-1)
         # compute registration loss 
-        batch_size = R.shape[0]
-        R_loss = torch.matmul(R_gt.transpose(2, 1), R) - torch.eye(3).to(R.device).unsqueeze(0).repeat(batch_size, 1, 1)
+        R_loss = torch.matmul(R_gt.transpose(2, 1), R) - self.eye3
         L_reg = torch.norm(R_loss, dim=(1, 2))**2 + torch.norm(S - S_gt, dim=1)**2 + torch.norm(t - t_gt, dim=1)**2
         # compute chamfer distance
         L_chamfer = chamfer_distance(x_aligned.transpose(2, 1), y.transpose(2, 1))[0].mean()
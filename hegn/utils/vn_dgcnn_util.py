@@ -1,12 +1,27 @@
 import torch
+from pytorch3d.ops import knn_points
+
+
+# pytorch3d only has register-tiled kNN kernels for small point dimensions, feature space
+# graphs (num_dims = 3 * C) would hit its generic kernel and stay on GEMM + topk
+KNN_POINTS_MAX_DIMS = 8
 
 
 def knn(x, k):
-    inner = -2*torch.matmul(x.transpose(2, 1), x)
-    xx = torch.sum(x**2, dim=1, keepdim=True)
-    pairwise_distance = -xx - inner - xx.transpose(2, 1)
+    # distances stay in float32 under autocast, reduced precision reorders close neighbours
+    with torch.autocast(device_type=x.device.type, enabled=False):
+        x = x.float()
+        if x.size(1) <= KNN_POINTS_MAX_DIMS:
+            # fused pairwise distance + top-k, never materialises the (batch_size, num_points, num_points) distances.
+            # unsorted: sorting checks the point counts on the host, which breaks CUDA graph capture,
+            # and the neighbours are only softmaxed or pooled over downstream
+            x = x.transpose(2, 1).contiguous()   # (batch_size, num_points, num_dims)
+            return knn_points(x, x, K=k, return_nn=False, return_sorted=False).idx   # (batch_size, num_points, k)
+        inner = -2*torch.matmul(x.transpose(2, 1), x)
+        xx = torch.sum(x**2, dim=1, keepdim=True)
+        pairwise_distance = -xx - inner - xx.transpose(2, 1)
  
-    idx = pairwise_distance.topk(k=k, dim=-1)[1]   # (batch_size, num_points, k)
+        idx = pairwise_distance.topk(k=k, dim=-1)[1]   # (batch_size, num_points, k)
     return idx
 
 
@@ -34,7 +49,7 @@ def get_graph_feature(x, k=20, idx=None, x_coord=None):
     x = x.transpose(2, 1).contiguous()   # (batch_size, num_points, num_dims)  -> (batch_size*num_points, num_dims) #   batch_size * num_points * k + range(0, batch_size*num_points)
     feature = x.view(batch_size*num_points, -1)[idx, :]
     feature = feature.view(batch_size, num_points, k, num_dims, 3) 
-    x = x.view(batch_size, num_points, 1, num_dims, 3).repeat(1, 1, k, 1, 1)
+    x = x.view(batch_size, num_points, 1, num_dims, 3).expand(-1, -1, k, -1, -1)
     
     feature = torch.cat((feature-x, x), dim=3).permute(0, 3, 4, 1, 2).contiguous()
   
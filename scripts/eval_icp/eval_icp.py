@@ -3,9 +3,7 @@ import torch
 from torch.utils.data import DataLoader
 from torchvision.transforms import Compose
 from pytorch3d.loss import chamfer_distance
-import copy
-import open3d as o3d
-import numpy as np
+from pytorch3d.ops import knn_points, knn_gather
 import time
 from tqdm import tqdm
 import sys
@@ -18,8 +16,44 @@ from scripts.utils.eval_utils import RMSE
 
 
 
+def batched_icp(x, y, max_correspondence_distance=0.02, max_iteration=30):
+    """
+        Point-to-point ICP on a whole batch at once, on the device of the inputs.
+        Mirrors open3d's registration_icp with an identity initial guess: correspondences
+        farther than max_correspondence_distance are ignored.
+        x: source points of shape [B, N, 3]
+        y: target points of shape [B, M, 3]
+        returns R [B, 3, 3] and t [B, 3] such that x @ R^T + t is aligned to y
+    """
+    B = x.size(0)
+    R = torch.eye(3, device=x.device, dtype=x.dtype).expand(B, 3, 3)
+    t = torch.zeros(B, 3, device=x.device, dtype=x.dtype)
+    for _ in range(max_iteration):
+        x_t = x @ R.transpose(-1, -2) + t.unsqueeze(1)
+        # nearest neighbour in y for every transformed source point (squared distances)
+        dists, idx, _ = knn_points(x_t, y, K=1)
+        y_c = knn_gather(y, idx).squeeze(2)  # B x N x 3
+        w = (dists < max_correspondence_distance ** 2).to(x.dtype)  # B x N x 1
+        n = w.sum(dim=1, keepdim=True)
+        valid = n.view(B) > 0
+        n = n.clamp(min=1)
+        # weighted Kabsch between the original source and its correspondences
+        x_mean = (w * x).sum(dim=1, keepdim=True) / n  # B x 1 x 3
+        y_mean = (w * y_c).sum(dim=1, keepdim=True) / n  # B x 1 x 3
+        H = torch.bmm((w * (x - x_mean)).transpose(-1, -2), y_c - y_mean)  # B x 3 x 3
+        U, _, Vh = torch.linalg.svd(H)
+        V = Vh.transpose(-1, -2)
+        D = torch.ones(B, 3, device=x.device, dtype=x.dtype)
+        D[:, 2] = torch.sign(torch.det(V @ U.transpose(-1, -2)))
+        R_new = V @ torch.diag_embed(D) @ U.transpose(-1, -2)
+        t_new = y_mean.squeeze(1) - (R_new @ x_mean.transpose(-1, -2)).squeeze(-1)
+        # keep the previous estimate for samples without any correspondence
+        R = torch.where(valid.view(B, 1, 1), R_new, R)
+        t = torch.where(valid.view(B, 1), t_new, t)
+    return R, t
+
+
 def eval(eval_type: str):
-    o3d.utility.set_verbosity_level(o3d.utility.VerbosityLevel.Error)
     device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
     batch_size = 32
 
@@ -38,73 +72,45 @@ def eval(eval_type: str):
             ]
         ),
     )
-    dataloader = DataLoader(dataset, batch_size=batch_size, shuffle=False)
+    # resample/transform/jitter in worker processes while the GPU registers the previous batch
+    dataloader = DataLoader(
+        dataset,
+        batch_size=batch_size,
+        shuffle=False,
+        num_workers=4,
+        pin_memory=device.type == "cuda",
+        persistent_workers=True,
+        prefetch_factor=2,
+    )
 
     rmse_loss = 0.0
     chamfer_loss = 0.0
     time_per_batch = []
     time_per_sample = []
     for _, batch in enumerate(tqdm(dataloader)):
-        x = batch["points"][:, :, :3]  # B x N x 3
-        y = batch["points_ts"][:, :, :3]  # B x N x 3
+        # copy the pinned tensors whole and slice/cast on the device, a strided slice or a
+        # dtype change on the host would go through a pageable temporary
+        x = batch["points"].to(device, non_blocking=True)[:, :, :3].float()  # B x N x 3
+        y = batch["points_ts"].to(device, non_blocking=True)[:, :, :3].float()  # B x N x 3
 
-        t_gt = batch["T"].to(device).to(torch.float32)  # B x 3
-        R_gt = batch["R"].to(device).to(torch.float32)  # B x 3 x 3
-        S_gt = batch["S"].to(device).to(torch.float32)  # B x 3 x 3
+        t_gt = batch["T"].to(device, non_blocking=True).float()  # B x 3
+        R_gt = batch["R"].to(device, non_blocking=True).float()  # B x 3 x 3
+        S_gt = batch["S"].to(device, non_blocking=True).float()  # B x 3 x 3
 
         curr_batch_size = x.size(0)
 
-        R_pred = []
-        S_pred = []
-        t_pred = []
-
-        x_aligned = []
-
-        for j in range(curr_batch_size):
-            source_pc = o3d.geometry.PointCloud()
-            source_pc.points = o3d.utility.Vector3dVector(x[j].numpy())
-            target_pc = o3d.geometry.PointCloud()
-            target_pc.points = o3d.utility.Vector3dVector(y[j].numpy())
-
-            start_time = time.time()
-            reg_p2p = o3d.pipelines.registration.registration_icp(
-                source_pc,
-                target_pc,
-                0.02,
-                np.eye(4),
-                o3d.pipelines.registration.TransformationEstimationPointToPoint(),
-            )
-            time_per_sample.append(time.time() - start_time)
-
-            # Extract transformations
-            R = (
-                torch.tensor(reg_p2p.transformation[:3, :3])
-                .to(device)
-                .to(torch.float32)
-            )
-            t = torch.tensor(reg_p2p.transformation[:3, 3]).to(device).to(torch.float32)
-            S = torch.eye(3).to(device).to(torch.float32)  # Assume no scaling
-
-            R_pred.append(R)
-            S_pred.append(S)
-            t_pred.append(t)
-
-            source_pc_aligned = copy.deepcopy(source_pc)
-            source_pc_aligned = source_pc_aligned.transform(reg_p2p.transformation)
-            source_pc_aligned = (
-                torch.tensor(np.array(source_pc_aligned.points))
-                .to(device)
-                .to(torch.float32)
-            )
-            x_aligned.append(source_pc_aligned)
-
-        time_per_batch.append(sum(time_per_sample[-curr_batch_size:]))
-
-        R_pred = torch.stack(R_pred).to(device).to(torch.float32)  # B x 3 x 3
-        S_pred = torch.stack(S_pred).to(device).to(torch.float32)  # B x 3 x 3
-        t_pred = torch.stack(t_pred).to(device).to(torch.float32)  # B x 3
-
-        x_aligned = torch.stack(x_aligned).to(device).to(torch.float32)  # B x N x 3
+        if device.type == "cuda":
+            torch.cuda.synchronize()
+        start_time = time.time()
+        R_pred, t_pred = batched_icp(x, y, 0.02)  # B x 3 x 3, B x 3
+        if device.type == "cuda":
+            torch.cuda.synchronize()
+        time_per_batch.append(time.time() - start_time)
+        time_per_sample.extend([time_per_batch[-1] / curr_batch_size] * curr_batch_size)
+
+        S_pred = torch.eye(3, device=device).expand(curr_batch_size, 3, 3)  # Assume no scaling
+
+        x_aligned = x @ R_pred.transpose(-1, -2) + t_pred.unsqueeze(1)  # B x N x 3
 
         rmse_loss += RMSE(
             x_aligned.transpose(2, 1),
@@ -115,7 +121,7 @@ def eval(eval_type: str):
             S_gt,
             t_gt,
         )
-        chamfer_loss += chamfer_distance(x_aligned, y.to(device).to(torch.float32))[0].mean()
+        chamfer_loss += chamfer_distance(x_aligned, y)[0].mean()
 
     print(f"ICP in {eval_type} results:")
     print(f"RMSE: {rmse_loss / len(dataloader)}")
@@ -4,7 +4,6 @@ from torch.utils.data import DataLoader
 from torchvision.transforms import Compose
 from pytorch3d.loss import chamfer_distance
 
-import copy
 import open3d as o3d
 import numpy as np
 import time
@@ -96,17 +95,15 @@ def eval(eval_type: str):
         x = batch["points"][:, :, :3]  # B x N x 3
         y = batch["points_ts"][:, :, :3]  # B x N x 3
 
-        t_gt = batch["T"].to(device).to(torch.float32)  # B x 3
-        R_gt = batch["R"].to(device).to(torch.float32)  # B x 3 x 3
-        S_gt = batch["S"].to(device).to(torch.float32)  # B x 3 x 3
+        t_gt = batch["T"].to(device, torch.float32)  # B x 3
+        R_gt = batch["R"].to(device, torch.float32)  # B x 3 x 3
+        S_gt = batch["S"].to(device, torch.float32)  # B x 3 x 3
 
         curr_batch_size = x.size(0)
 
-        R_pred = []
-        S_pred = []
-        t_pred = []
-
-        x_aligned = []
+        # filled on the host and copied to the device once per batch
+        transforms = np.empty((curr_batch_size, 4, 4), dtype=np.float32)
+        x_aligned = np.empty((curr_batch_size, x.size(1), 3), dtype=np.float32)
 
         for j in range(curr_batch_size):
             source_pc = o3d.geometry.PointCloud()
@@ -139,35 +136,19 @@ def eval(eval_type: str):
             )
             time_per_sample.append(time.time() - start_time)
 
-            # Extract transformations
-            R = (
-                torch.tensor(reg_p2p.transformation[:3, :3])
-                .to(device)
-                .to(torch.float32)
-            )
-            t = torch.tensor(reg_p2p.transformation[:3, 3]).to(device).to(torch.float32)
-            S = torch.eye(3).to(device).to(torch.float32)  # Assume no scaling
-
-            R_pred.append(R)
-            S_pred.append(S)
-            t_pred.append(t)
-
-            source_pc_aligned = copy.deepcopy(source_pc)
-            source_pc_aligned = source_pc_aligned.transform(reg_p2p.transformation)
-            source_pc_aligned = (
-                torch.tensor(np.array(source_pc_aligned.points))
-                .to(device)
-                .to(torch.float32)
-            )
-            x_aligned.append(source_pc_aligned)
+            T = reg_p2p.transformation.astype(np.float32)
+            transforms[j] = T
+            x_aligned[j] = x[j].numpy() @ T[:3, :3].T + T[:3, 3]
 
         time_per_batch.append(sum(time_per_sample[-curr_batch_size:]))
 
-        R_pred = torch.stack(R_pred).to(device).to(torch.float32)  # B x 3 x 3
-        S_pred = torch.stack(S_pred).to(device).to(torch.float32)  # B x 3 x 3
-        t_pred = torch.stack(t_pred).to(device).to(torch.float32)  # B x 3
+        # Extract transformations
+        transforms = torch.from_numpy(transforms).to(device)
+        R_pred = transforms[:, :3, :3]  # B x 3 x 3
+        t_pred = transforms[:, :3, 3]  # B x 3
+        S_pred = torch.eye(3, device=device).expand(curr_batch_size, 3, 3)  # Assume no scaling
 
-        x_aligned = torch.stack(x_aligned).to(device).to(torch.float32)  # B x N x 3
+        x_aligned = torch.from_numpy(x_aligned).to(device)  # B x N x 3
 
         rmse_loss += RMSE(
             x_aligned.transpose(2, 1),
@@ -178,7 +159,7 @@ def eval(eval_type: str):
             S_gt,
             t_gt,
         )
-        chamfer_loss += chamfer_distance(x_aligned, y.to(device).to(torch.float32))[0].mean()
+        chamfer_loss += chamfer_distance(x_aligned, y.to(device, torch.float32))[0].mean()
 
     print(f"ICP+RANSAC in {eval_type} results:")
     print(f"RMSE: {rmse_loss / len(dataloader)}")
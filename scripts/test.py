@@ -6,6 +6,7 @@ from torchvision.transforms import Compose
 
 import open3d as o3d
 import time
+import functools
 import tqdm
 import os
 import sys
@@ -23,10 +24,43 @@ from hegn.dataloader.transforms import (
                         RandomTransformSE3
                     )
 
+def capture_model(model, x, y, use_amp, num_warmup=3):
+    """
+        Capture the HEGN feature extraction for inputs shaped like x and y into a CUDA graph
+        and return a callable with the model signature that replays it.
+        The alignment SVD synchronizes with the host, so it runs eagerly after the replay;
+        nothing inside model.features may synchronize (see knn).
+    """
+    static_x = x.clone()
+    static_y = y.clone()
+    # autocast's weight cast cache can not be used during graph capture
+    amp = functools.partial(torch.autocast, device_type='cuda', dtype=torch.bfloat16,
+                            enabled=use_amp, cache_enabled=False)
+    # warm up on a side stream as required before capture
+    stream = torch.cuda.Stream()
+    stream.wait_stream(torch.cuda.current_stream())
+    with torch.cuda.stream(stream), amp():
+        for _ in range(num_warmup):
+            model.features(static_x, static_y)
+    torch.cuda.current_stream().wait_stream(stream)
+
+    graph = torch.cuda.CUDAGraph()
+    with torch.cuda.graph(graph), amp():
+        static_fx, static_fy = model.features(static_x, static_y)
+
+    def run(x, y):
+        static_x.copy_(x, non_blocking=True)
+        static_y.copy_(y, non_blocking=True)
+        graph.replay()
+        return model.alignment(static_fx, static_fy)
+    return run
+
+
 @hydra.main(config_path="../config", config_name="test_config")
 def main(cfg: DictConfig):
     # Set device
     device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    use_amp = device.type == 'cuda'
     batch_size = cfg.batch_size
 
     # Create dataset and dataloader
@@ -61,16 +95,18 @@ def main(cfg: DictConfig):
             self.n_knn = [20, 20, 16, 16]
             self.topk = [4, 4, 2, 2]
             self.num_blocks = len(self.vngcnn_in)
+            self.svd_device = cfg.svd_device
             
     args = Args()
 
     # Define loss function and optimizer
-    criterion = HEGN_Loss()
+    criterion = HEGN_Loss().to(device)
 
     # Load the model from the checkpoint
     model = HEGN(args=args).to(device)
     model.load_state_dict(torch.load(cfg.checkpoint_path))
     model.eval()
+    graphed_model = None
 
     # save paths
     if cfg.save_output:
@@ -101,9 +137,16 @@ def main(cfg: DictConfig):
             y_centroid = y.mean(dim=2, keepdim=True)    
             x_par = x - x_centroid
             y_par = y - y_centroid
-            # stop the logging
+            # replay a CUDA graph for full batches, the input shapes are fixed there
+            use_graph = device.type == 'cuda' and curr_batch_size == batch_size
+            if use_graph and graphed_model is None:
+                graphed_model = capture_model(model, x_par, y_par, use_amp)
             start_time = time.time()
-            R, S = model(x_par, y_par)
+            if use_graph:
+                R, S = graphed_model(x_par, y_par)
+            else:
+                with torch.autocast(device_type=device.type, dtype=torch.bfloat16, enabled=use_amp):
+                    R, S = model(x_par, y_par)
             t = y_centroid - torch.matmul(R, x_centroid)
             S = torch.diag_embed(S)
             # uncomment the following line to if you want to test only 6dof
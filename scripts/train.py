@@ -26,6 +26,7 @@ from hegn.dataloader.transforms import (
 def train():
     # Set device
     device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    use_amp = device.type == 'cuda'
         
     # Define hyperparameters
     learning_rate = 1e-3
@@ -60,16 +61,19 @@ def train():
             self.n_knn = [20, 20, 16, 16]
             self.topk = [4, 4, 2, 2]
             self.num_blocks = len(self.vngcnn_in)
+            self.svd_device = None
 
     args = Args()
     model = HEGN(args=args).to(device)
+    # the compiled wrapper shares its parameters with model, so the checkpoint keys stay unchanged
+    compiled_model = torch.compile(model)
     
     logging.info(f"number of parameters in HEGN: {sum(p.numel() for p in model.parameters() if p.requires_grad)}")
     logging.info(f"dataloader length: {len(train_dataloader)}")
     logging.info(f"sample in one batch: {next(iter(vaild_dataloader))['points'].size()}")
 
     # Define loss function and optimizer
-    criterion = HEGN_Loss()
+    criterion = HEGN_Loss().to(device)
 
     if optimizer_name == 'adam':
         optimizer = optim.Adam(model.parameters(), lr=learning_rate, weight_decay=1e-5, betas=(0.9, 0.99))
@@ -114,7 +118,8 @@ def train():
             x_par = x - x_centroid
             y_par = y - y_centroid
             optimizer.zero_grad()
-            R, S = model(x_par, y_par)
+            with torch.autocast(device_type=device.type, dtype=torch.bfloat16, enabled=use_amp):
+                R, S = compiled_model(x_par, y_par)
             t = y_centroid - torch.matmul(R, x_centroid)
             S = torch.diag_embed(S)
             x_aligned = torch.matmul(R, S @ x_par) + t
@@ -127,7 +132,6 @@ def train():
             optimizer.step()
 
         # show memory usage
-        logging.disable(logging.NOTSET)
         logging.info(f"memory allocated: {torch.cuda.memory_allocated()/1e9}")
         logging.info(f"memory cached: {torch.cuda.memory_reserved()/1e9}")
         # Validation loop
@@ -147,7 +151,8 @@ def train():
                 y_centroid = y.mean(dim=2, keepdim=True)
                 x_par = x - x_centroid
                 y_par = y - y_centroid
-                R, S = model(x_par, y_par)
+                with torch.autocast(device_type=device.type, dtype=torch.bfloat16, enabled=use_amp):
+                    R, S = compiled_model(x_par, y_par)
                 t = y_centroid - torch.matmul(R, x_centroid)
                 S = torch.diag_embed(S)
                 x_aligned = torch.matmul(R, S @ x_par) + t
@@ -170,7 +175,6 @@ def train():
         logging.info(f"epoch {epoch} vaild loss: {vaild_batches_loss/len(vaild_dataloader)}, \
             reg loss: {vaild_batches_loss_reg/len(vaild_dataloader)}, \
             chm loss: {vaild_batches_loss_chm/len(vaild_dataloader)}")
-        logging.disable(logging.ERROR)
     # Save the model
     torch.save(model.state_dict(), 'checkpoints/hegn.pth')
     wandb.finish()